@@ -20,16 +20,17 @@ Item Model that uses Redis
 You must initlaize this class before use by calling inititlize().
 This class looks for an environment variable called VCAP_SERVICES
 to get it's database credentials from. If it cannot find one, it
+uses the REDIS_URL environment variable if it is set, and otherwise
 tries to connect to Redis on the localhost. If that fails it looks
 for a server name 'redis' to connect to.
 """
 
 import os
 import json
+import threading
 import logging
-import pickle
 from cerberus import Validator
-from redis import Redis
+from redis import Redis, ConnectionPool
 from redis.exceptions import ConnectionError
 from app.custom_exceptions import DataValidationError
 
@@ -43,13 +44,48 @@ class Item(object):
 
     logger = logging.getLogger(__name__)
     redis = None
+    scan_count = 1024   # keys fetched per SCAN cursor step
+    batch_size = 512    # Items fetched per pipelined round-trip
+    indexes = ('name', 'price', 'available')    # searchable attributes
+    generation_key = 'meta:generation'  # bumped by every write
     schema = {
         'id': {'type': 'integer'},
         'name': {'type': 'string', 'required': True},
         'price': {'type': 'string', 'required': True},
         'available': {'type': 'boolean', 'required': True}
         }
-    __validator = Validator(schema)
+    # a Validator keeps the document it is checking on itself, so each
+    # thread (or green thread under eventlet) gets its own instance
+    __validators = threading.local()
+    # Lua script that returns the hash of every Item id in an index set
+    __find_by_lua = """
+        local rows = {}
+        for _, item_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+            local fields = redis.call('HGETALL', ARGV[1] .. item_id)
+            if #fields > 0 then
+                rows[#rows + 1] = fields
+            end
+        end
+        return rows
+        """
+    __find_by_script = None
+    # Lua script that flips an available Item to unavailable atomically
+    __purchase_lua = """
+        local available = redis.call('HGET', KEYS[1], 'available')
+        if not available then
+            return -1
+        end
+        if available == '0' then
+            return 0
+        end
+        redis.call('HSET', KEYS[1], 'available', '0')
+        redis.call('SREM', KEYS[2], ARGV[1])
+        redis.call('SADD', KEYS[3], ARGV[1])
+        redis.call('INCR', KEYS[4])
+        return redis.call('HGETALL', KEYS[1])
+        """
+    __purchase_script = None
+    __pools = {}    # connection pools shared by every init_db() call
 
     def __init__(self, id=0, name=None, price=None, available=True):
         """ Constructor """
@@ -62,13 +98,35 @@ class Item(object):
         """ Saves a Item in the database """
         if self.name is None:   # name is the only required field
             raise DataValidationError('name attribute is not set')
+        old_data = None
         if self.id == 0:
             self.id = Item.__next_index()
-        Item.redis.set(self.id, pickle.dumps(self.serialize()))
+        else:   # fetch the old values so their index entries can be removed
+            old_data = Item.redis.hgetall(Item.__key(self.id))
+        data = self.serialize()
+        # update the record and its secondary indexes atomically
+        pipe = Item.redis.pipeline()
+        if old_data:
+            for index in Item.__index_keys(Item.__from_hash(old_data)):
+                pipe.srem(index, self.id)
+        pipe.hmset(Item.__key(self.id), Item.__to_hash(data))
+        for index in Item.__index_keys(data):
+            pipe.sadd(index, self.id)
+        pipe.incr(Item.generation_key)
+        pipe.execute()
 
     def delete(self):
         """ Deletes a Item from the database """
-        Item.redis.delete(self.id)
+        key = Item.__key(self.id)
+        old_data = Item.redis.hgetall(key)
+        if not old_data:
+            return
+        pipe = Item.redis.pipeline()
+        for index in Item.__index_keys(Item.__from_hash(old_data)):
+            pipe.srem(index, self.id)
+        pipe.delete(key)
+        pipe.incr(Item.generation_key)
+        pipe.execute()
 
     def serialize(self):
         """ serializes a Item into a dictionary """
@@ -81,23 +139,128 @@ class Item(object):
 
     def deserialize(self, data):
         """ deserializes a Item my marshalling the data """
-        if isinstance(data, dict) and Item.__validator.validate(data):
+        validator = Item.__validator()
+        # the schema has no normalization rules, so validation skips that pass
+        if isinstance(data, dict) and validator.validate(data, normalize=False):
             self.name = data['name']
             self.price = data['price']
             self.available = data['available']
         else:
-            raise DataValidationError('Invalid item data: ' + str(Item.__validator.errors))
+            raise DataValidationError('Invalid item data: ' + str(validator.errors))
         return self
 
+    @classmethod
+    def from_trusted_dict(cls, data):
+        """ Creates a Item from data read back from the database without validating it """
+        item = cls.__new__(cls)
+        item.id = int(data['id'])
+        item.name = data['name']
+        item.price = data['price']
+        item.available = data['available']
+        return item
+
 
 ######################################################################
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
 
     @staticmethod
-    def __next_index():
-        """ Increments the index and returns it """
-        return Item.redis.incr('index')
+    def __validator():
+        """ Returns the Validator of the current thread, creating it only once """
+        validator = getattr(Item.__validators, 'validator', None)
+        if validator is None:
+            validator = Validator(Item.schema, purge_unknown=False)
+            Item.__validators.validator = validator
+        return validator
+
+    @staticmethod
+    def __key(item_id):
+        """ Returns the Redis key that an Item is stored under """
+        return 'item:{}'.format(item_id)
+
+    @staticmethod
+    def __to_hash(data):
+        """ Converts serialized Item data into Redis hash fields """
+        fields = dict(data)
+        fields['available'] = int(data['available'])
+        return fields
+
+    @staticmethod
+    def __from_hash(fields):
+        """ Converts Redis hash fields back into serialized Item data """
+        return {
+            "id": int(fields['id']),
+            "name": Item.__text(fields['name']),
+            "price": Item.__text(fields['price']),
+            "available": fields['available'] == '1'
+        }
+
+    @staticmethod
+    def __text(value):
+        """ Decodes the UTF-8 bytes that Redis returns into unicode """
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return value
+
+    @staticmethod
+    def __from_reply(row):
+        """ Converts a flat HGETALL reply from a Lua script into Item data """
+        return Item.__from_hash(dict(zip(row[::2], row[1::2])))
+
+    @staticmethod
+    def __index_key(attribute, value):
+        """ Returns the key of the set of Item ids with a given value """
+        if isinstance(value, basestring):
+            value = Item.__text(value).lower()   # make case insensitive
+        return u'idx:{}:{}'.format(attribute, value)
+
+    @staticmethod
+    def __index_keys(data):
+        """ Returns the index sets that an Item's data belongs to """
+        return [Item.__index_key(attribute, data[attribute]) for attribute in Item.indexes]
+
+    @staticmethod
+    def __next_index(count=1):
+        """ Increments the index by count and returns the last new value """
+        return Item.redis.incr('meta:id_counter', count)
+
+    @staticmethod
+    def save_many(items):
+        """ Saves a list of new Items in two round-trips """
+        if not items:
+            return
+        for item in items:
+            if item.name is None:
+                raise DataValidationError('name attribute is not set')
+        first_id = Item.__next_index(len(items)) - len(items) + 1
+        pipe = Item.redis.pipeline()
+        for item_id, item in enumerate(items, first_id):
+            item.id = item_id
+            data = item.serialize()
+            pipe.hmset(Item.__key(item.id), Item.__to_hash(data))
+            for index in Item.__index_keys(data):
+                pipe.sadd(index, item.id)
+        pipe.incr(Item.generation_key)
+        pipe.execute()
+
+    @staticmethod
+    def purchase(item_id):
+        """
+        Marks a Item as unavailable in a single atomic call
+
+        Returns the purchased Item, None if it was not found,
+        or False if it was not available
+        """
+        result = Item.__purchase_script(keys=[Item.__key(item_id),
+                                              Item.__index_key('available', True),
+                                              Item.__index_key('available', False),
+                                              Item.generation_key],
+                                        args=[item_id])
+        if result == -1:
+            return None
+        if result == 0:
+            return False
+        return Item.from_trusted_dict(Item.__from_reply(result))
 
     # @staticmethod
     # def use_db(redis):
@@ -105,21 +268,67 @@ class Item(object):
 
     @staticmethod
     def remove_all():
-        """ Removes all Items from the database """
-        Item.redis.flushall()
+        """ Removes all Items, their indexes and the id counter """
+        keys = ['meta:id_counter']
+        for pattern in ('item:*', 'idx:*'):
+            for key in Item.redis.scan_iter(match=pattern, count=Item.scan_count):
+                keys.append(key)
+                if len(keys) == Item.batch_size:
+                    # UNLINK frees the memory in a background thread
+                    Item.redis.execute_command('UNLINK', *keys)
+                    keys = []
+        if keys:
+            Item.redis.execute_command('UNLINK', *keys)
+        # the generation only ever goes up so no old cached list is reused
+        Item.redis.incr(Item.generation_key)
 
     @staticmethod
     def all():
         """ Query that returns all Items """
-        # results = [Item.from_dict(redis.hgetall(key)) for key in redis.keys() if key != 'index']
         results = []
-        for key in Item.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Item.redis.get(key))
-                item = Item(data['id']).deserialize(data)
-                results.append(item)
+        for data in Item.__scan_all():
+            item = Item.from_trusted_dict(data)
+            results.append(item)
         return results
 
+    @staticmethod
+    def generation():
+        """ Returns a value that changes whenever any Item is written """
+        return Item.redis.get(Item.generation_key)
+
+    @staticmethod
+    def count():
+        """ Returns the number of Items without fetching them """
+        # every Item is in exactly one of the two availability indexes
+        pipe = Item.redis.pipeline(transaction=False)
+        pipe.scard(Item.__index_key('available', True))
+        pipe.scard(Item.__index_key('available', False))
+        return sum(pipe.execute())
+
+    @staticmethod
+    def __scan_all():
+        """ Generator that fetches every stored Item in pipelined batches """
+        keys = []
+        for key in Item.redis.scan_iter(match='item:*', count=Item.scan_count):
+            keys.append(key)
+            if len(keys) == Item.batch_size:
+                for data in Item.__load_many(keys):
+                    yield data
+                keys = []
+        for data in Item.__load_many(keys):
+            yield data
+
+    @staticmethod
+    def __load_many(keys):
+        """ Fetches the data for a list of keys in a single round-trip """
+        if not keys:
+            return []
+        pipe = Item.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        # a key may have been deleted since its id was read
+        return [Item.__from_hash(fields) for fields in pipe.execute() if fields]
+
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
@@ -127,32 +336,23 @@ class Item(object):
     @staticmethod
     def find(item_id):
         """ Query that finds Items by their id """
-        if Item.redis.exists(item_id):
-            data = pickle.loads(Item.redis.get(item_id))
-            item = Item(data['id']).deserialize(data)
+        fields = Item.redis.hgetall(Item.__key(item_id))
+        if fields:
+            data = Item.__from_hash(fields)
+            item = Item.from_trusted_dict(data)
             return item
         return None
 
     @staticmethod
     def __find_by(attribute, value):
-        """ Generic Query that finds a key with a specific value """
-        # return [item for item in Item.__data if item.price == price]
+        """ Generic Query that finds Items with a specific value """
         Item.logger.info('Processing %s query for %s', attribute, value)
-        if isinstance(value, str):
-            search_criteria = value.lower() # make case insensitive
-        else:
-            search_criteria = value
+        # resolve the index and fetch the matches in one server-side call
+        rows = Item.__find_by_script(keys=[Item.__index_key(attribute, value)],
+                                     args=[Item.__key('')])
         results = []
-        for key in Item.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Item.redis.get(key))
-                # perform case insensitive search on strings
-                if isinstance(data[attribute], str):
-                    test_value = data[attribute].lower()
-                else:
-                    test_value = data[attribute]
-                if test_value == search_criteria:
-                    results.append(Item(data['id']).deserialize(data))
+        for row in rows:
+            results.append(Item.from_trusted_dict(Item.__from_reply(row)))
         return results
 
     @staticmethod
@@ -175,18 +375,58 @@ class Item(object):
 ######################################################################
 
     @staticmethod
-    def connect_to_redis(hostname, port, password):
-        """ Connects to Redis and tests the connection """
-        Item.logger.info("Testing Connection to: %s:%s", hostname, port)
-        Item.redis = Redis(host=hostname, port=port, password=password)
+    def __register_scripts():
+        """ Registers the Lua scripts with the current connection """
+        Item.__find_by_script = Item.redis.register_script(Item.__find_by_lua)
+        Item.__purchase_script = Item.redis.register_script(Item.__purchase_lua)
+
+    @staticmethod
+    def __shared_pool(url=None, **settings):
+        """ Returns the ConnectionPool for these settings, creating it only once """
+        pool_key = url or tuple(sorted(settings.items()))
+        if pool_key not in Item.__pools:
+            options = {
+                'socket_keepalive': True,
+                'max_connections': int(os.environ.get('REDIS_POOL_SIZE', 50))
+            }
+            if url:
+                pool = ConnectionPool.from_url(url, **options)
+            else:
+                options.update(settings)
+                pool = ConnectionPool(**options)
+            Item.__pools[pool_key] = pool
+        return Item.__pools[pool_key]
+
+    @staticmethod
+    def __connect(pool, location):
+        """ Uses a connection pool and tests the connection """
+        Item.redis = Redis(connection_pool=pool)
         try:
             Item.redis.ping()
             Item.logger.info("Connection established")
         except ConnectionError:
-            Item.logger.info("Connection Error from: %s:%s", hostname, port)
+            Item.logger.info("Connection Error from: %s", location)
             Item.redis = None
         return Item.redis
 
+    @staticmethod
+    def connect_to_redis(hostname, port, password):
+        """ Connects to Redis and tests the connection """
+        Item.logger.info("Testing Connection to: %s:%s", hostname, port)
+        pool = Item.__shared_pool(host=hostname, port=port, password=password)
+        return Item.__connect(pool, '{}:{}'.format(hostname, port))
+
+    @staticmethod
+    def connect_to_url(url):
+        """ Connects to Redis using a redis:// URL and tests the connection """
+        pool = Item.__shared_pool(url)
+        # log the host and port only, the URL may contain a password
+        settings = pool.connection_kwargs
+        location = '{}:{}'.format(settings.get('host', settings.get('path')),
+                                  settings.get('port', ''))
+        Item.logger.info("Testing Connection to: %s", location)
+        return Item.__connect(pool, location)
+
     @staticmethod
     def init_db(redis=None):
         """
@@ -194,9 +434,13 @@ class Item(object):
 
         This method will work in the following conditions:
           1) In Bluemix with Redis bound through VCAP_SERVICES
-          2) With Redis running on the local server as with Travis CI
-          3) With Redis --link in a Docker container called 'redis'
-          4) Passing in your own Redis connection object
+          2) With a Redis URL in the REDIS_URL environment variable
+          3) With Redis running on the local server as with Travis CI
+          4) With Redis --link in a Docker container called 'redis'
+          5) Passing in your own Redis connection object
+
+        Connection pools are shared, so calling this again reuses the
+        sockets that are already open to the same server.
 
         Exception:
         ----------
@@ -212,6 +456,7 @@ class Item(object):
                 Item.logger.error("Client Connection Error!")
                 Item.redis = None
                 raise ConnectionError('Could not connect to the Redis Service')
+            Item.__register_scripts()
             return
         # Get the credentials from the Bluemix environment
         if 'VCAP_SERVICES' in os.environ:
@@ -222,6 +467,9 @@ class Item(object):
             Item.logger.info("Conecting to Redis on host %s port %s",
                             creds['hostname'], creds['port'])
             Item.connect_to_redis(creds['hostname'], creds['port'], creds['password'])
+        elif 'REDIS_URL' in os.environ:
+            Item.logger.info("Using REDIS_URL...")
+            Item.connect_to_url(os.environ['REDIS_URL'])
         else:
             Item.logger.info("VCAP_SERVICES not found, checking localhost for Redis")
             Item.connect_to_redis('127.0.0.1', 6379, None)
@@ -232,3 +480,4 @@ class Item(object):
             # if you end up here, redis instance is down.
             Item.logger.fatal('*** FATAL ERROR: Could not connect to the Redis Service')
             raise ConnectionError('Could not connect to the Redis Service')
+        Item.__register_scripts()
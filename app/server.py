@@ -21,35 +21,53 @@ Paths:
 ------
 GET / - Displays a UI for Selenium testing
 GET /items - Returns a list all of the Items
+HEAD /items - Returns the number of Items in the X-Total-Count header
 GET /items/{id} - Returns the Item with a given id number
 POST /items - creates a new Item record in the database
 PUT /items/{id} - updates a Item record in the database
 DELETE /items/{id} - deletes a Item record in the database
 """
 
+import os
 import sys
 import logging
+try:
+    import ujson
+except ImportError:     # PyPy's JIT makes the standard library json fast enough
+    import json as ujson
 from flask import jsonify, request, json, url_for, make_response, abort
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
 from app.models import Item
 from . import app
 
-import eventlet
 from flask_mqtt import Mqtt
 from flask_socketio import SocketIO
 from flask_bootstrap import Bootstrap
 
-eventlet.monkey_patch()
+# Green threads are only needed when serving WebSockets, and patching
+# every socket slows down the plain blocking Redis calls otherwise
+USE_EVENTLET = (os.getenv('USE_EVENTLET', '0') == '1')
+if USE_EVENTLET:
+    import eventlet
+    eventlet.monkey_patch()
 
 mqtt = Mqtt(app)
-socketio = SocketIO(app)
+socketio = SocketIO(app, async_mode='eventlet' if USE_EVENTLET else 'threading')
 bootstrap = Bootstrap(app)
 count = 0
 
 topic = 'channel01'
 message = ''
 
+# GET /items responses cached as (body, count) by the Redis write
+# generation and query, so a write from any process retires them
+LIST_CACHE_SIZE = 128
+list_cache = {}
+
+# Base of the Location URL for new Items keyed by request.url_root
+items_url_bases = {}
+
 # Error handlers reuire app to be initialized so we must import
 # then only after we have initialized the Flask app instance
 import error_handlers
@@ -81,15 +99,30 @@ def list_items():
     items = []
     price = request.args.get('price')
     name = request.args.get('name')
-    if price:
-        items = Item.find_by_price(price)
-    elif name:
-        items = Item.find_by_name(name)
+    if request.method == 'HEAD' and not (price or name):
+        # only the count is wanted so the Items are never fetched
+        return json_response('', status.HTTP_200_OK, {'X-Total-Count': Item.count()})
+    # read before the Items, so a list fetched during a write is filed
+    # under the old generation and never served after it
+    cache_key = (Item.generation(), price or '', name or '')
+    cached = list_cache.get(cache_key)
+    if cached:
+        body, count = cached
     else:
-        items = Item.all()
-
-    results = [item.serialize() for item in items]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+        if price:
+            items = Item.find_by_price(price)
+        elif name:
+            items = Item.find_by_name(name)
+        else:
+            items = Item.all()
+
+        results = [item.serialize() for item in items]
+        body = ujson.dumps(results)
+        count = len(results)
+        if len(list_cache) >= LIST_CACHE_SIZE:
+            list_cache.clear()
+        list_cache[cache_key] = (body, count)
+    return json_response(body, status.HTTP_200_OK, {'X-Total-Count': count})
 
 
 ######################################################################
@@ -105,7 +138,7 @@ def get_items(item_id):
     item = Item.find(item_id)
     if not item:
         raise NotFound("Item with id '{}' was not found.".format(item_id))
-    return make_response(jsonify(item.serialize()), status.HTTP_200_OK)
+    return json_response(ujson.dumps(item.serialize()), status.HTTP_200_OK)
 
 ######################################################################
 # ADD A NEW PET
@@ -127,14 +160,15 @@ def create_items():
         }
     else:
         app.logger.info('Getting data from API call')
-        data = request.get_json()
-    app.logger.info(data)
+        data = get_json_body()
+    app.logger.debug('%s', data)
     item = Item()
     item.deserialize(data)
     item.save()
+    invalidate_list_cache()
     message = item.serialize()
-    location_url = url_for('get_items', item_id=item.id, _external=True)
-    return make_response(jsonify(message), status.HTTP_201_CREATED,
+    location_url = items_url_base() + str(item.id)
+    return json_response(ujson.dumps(message), status.HTTP_201_CREATED,
                          {'Location': location_url})
 
 
@@ -152,14 +186,15 @@ def update_items(item_id):
     item = Item.find(item_id)
     if not item:
         raise NotFound("Item with id '{}' was not found.".format(item_id))
-    data = request.get_json()
-    app.logger.info(data)
+    data = get_json_body()
+    app.logger.debug('%s', data)
     item.deserialize(data)
     item.id = item_id
     item.save()
-    mqtt_update_message = "Price of the Item with id '{}' and name '{}' was changed.".format(item_id, item.name)
-    mqtt.publish(topic, mqtt_update_message)
-    return make_response(jsonify(item.serialize()), status.HTTP_200_OK)
+    invalidate_list_cache()
+    mqtt_update_message = u"Price of the Item with id '{}' and name '{}' was changed.".format(item_id, item.name)
+    mqtt.publish(topic, mqtt_update_message.encode('utf-8'))
+    return json_response(ujson.dumps(item.serialize()), status.HTTP_200_OK)
 
 ######################################################################
 # DELETE A PET
@@ -174,6 +209,7 @@ def delete_items(item_id):
     item = Item.find(item_id)
     if item:
         item.delete()
+        invalidate_list_cache()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
@@ -182,14 +218,13 @@ def delete_items(item_id):
 @app.route('/items/<int:item_id>/purchase', methods=['PUT'])
 def purchase_items(item_id):
     """ Purchasing a Item makes it unavailable """
-    item = Item.find(item_id)
-    if not item:
+    item = Item.purchase(item_id)
+    if item is None:
         abort(status.HTTP_404_NOT_FOUND, "Item with id '{}' was not found.".format(item_id))
-    if not item.available:
+    if item is False:
         abort(status.HTTP_400_BAD_REQUEST, "Item with id '{}' is not available.".format(item_id))
-    item.available = False
-    item.save()
-    return make_response(jsonify(item.serialize()), status.HTTP_200_OK)
+    invalidate_list_cache()
+    return json_response(ujson.dumps(item.serialize()), status.HTTP_200_OK)
 
 ######################################################################
 # DELETE ALL PET DATA (for testing only)
@@ -198,6 +233,7 @@ def purchase_items(item_id):
 def items_reset():
     """ Removes all items from the database """
     Item.remove_all()
+    invalidate_list_cache()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
@@ -208,16 +244,54 @@ def items_reset():
 def init_db(redis=None):
     """ Initlaize the model """
     Item.init_db(redis)
+    invalidate_list_cache()
 
 # load sample data
 def data_load(payload):
     """ Loads a Item into the database """
     item = Item(0, payload['name'], payload['price'])
     item.save()
+    invalidate_list_cache()
+
+def data_load_many(payloads):
+    """ Loads a list of Items into the database """
+    items = [Item(0, payload['name'], payload['price']) for payload in payloads]
+    Item.save_many(items)
+    invalidate_list_cache()
 
 def data_reset():
     """ Removes all Items from the database """
     Item.remove_all()
+    invalidate_list_cache()
+
+def json_response(body, status_code, headers=None):
+    """ Makes a response from an already encoded JSON body """
+    response = make_response(body, status_code, headers or {})
+    response.mimetype = 'application/json'
+    return response
+
+def items_url_base():
+    """ Returns the external URL of the Items collection ending in a slash """
+    base = items_url_bases.get(request.url_root)
+    if base is None:
+        base = url_for('get_items', item_id=0, _external=True).rsplit('/', 1)[0] + '/'
+        if len(items_url_bases) >= LIST_CACHE_SIZE:  # the Host header is client supplied
+            items_url_bases.clear()
+        items_url_bases[request.url_root] = base
+    return base
+
+def invalidate_list_cache():
+    """ Frees the cached Item lists, which can no longer be served after a write """
+    list_cache.clear()
+
+def get_json_body():
+    """ Parses a JSON request body with ujson """
+    if not request.is_json:
+        return None
+    try:
+        return ujson.loads(request.get_data())
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, 'Request body is not valid JSON')
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
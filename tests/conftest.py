@@ -0,0 +1,134 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test Fixtures
+
+The suite runs in parallel with pytest-xdist, so every worker process
+is given its own Redis database through REDIS_URL. That keeps one test
+file from removing the Items another file is still using.
+"""
+
+import os
+import logging
+import pytest
+from app import server
+
+# the number of databases the Redis server is configured with
+REDIS_DATABASES = int(os.getenv('REDIS_DATABASES', '16'))
+
+WORKER = os.getenv('PYTEST_XDIST_WORKER')
+OWN_DB = bool(WORKER) and 'REDIS_URL' not in os.environ
+if OWN_DB:
+    # gw0 -> db 1, gw1 -> db 2, ... leaving db 0 for development
+    WORKER_DB = int(WORKER[2:]) + 1
+    if WORKER_DB >= REDIS_DATABASES:
+        raise pytest.UsageError('Worker {} has no Redis database of its own, run at most {} '
+                                'workers or set REDIS_DATABASES'.format(WORKER, REDIS_DATABASES - 1))
+    os.environ['REDIS_URL'] = 'redis://127.0.0.1:6379/{}'.format(WORKER_DB)
+
+
+def pytest_configure(config):
+    """ Starts no more workers than there are Redis databases to give them """
+    workers = getattr(config.option, 'numprocesses', None)
+    if workers and not WORKER and 'REDIS_URL' not in os.environ:
+        # workers sharing a database would empty it under each other
+        config.option.numprocesses = min(workers, REDIS_DATABASES - 1)
+
+# Sample Items every server test starts with
+FIDO = {"name": "fido", "price": "dog", "available": True}
+KITTY = {"name": "kitty", "price": "cat", "available": True}
+
+
+######################################################################
+#  F I X T U R E S
+######################################################################
+
+@pytest.fixture(scope='session')
+def db():
+    """ Connects to Redis once per worker and snapshots the sample Items """
+    server.initialize_logging(logging.CRITICAL)
+    server.init_db()
+    reset()
+    server.data_load_many([FIDO, KITTY])
+    redis = server.Item.redis
+    return dict((key, redis.dump(key))
+                for pattern in ('item:*', 'idx:*', 'meta:*')
+                for key in redis.scan_iter(match=pattern))
+
+
+@pytest.fixture(scope='module')
+def test_client():
+    """ Creates one Flask test client per test module """
+    return server.app.test_client()
+
+
+@pytest.fixture(scope='class')
+def readonly_client(db, test_client):
+    """ Returns the test client for a class of tests that never change the Items """
+    restore(db)
+    return test_client
+
+
+@pytest.fixture
+def empty_db():
+    """ Removes every Item before a model test """
+    if not server.Item.redis or not using_own_db():
+        # a connection test may have dropped or replaced the connection
+        server.Item.init_db()
+    reset()
+
+
+@pytest.fixture
+def client(db, test_client):
+    """ Returns the test client for a database holding the sample Items """
+    restore(db)
+    test_client.cookie_jar.clear()
+    return test_client
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+def using_own_db():
+    """ Checks that Redis is connected to the database of this worker """
+    return OWN_DB and server.Item.redis.connection_pool.connection_kwargs.get('db') == WORKER_DB
+
+
+def reset():
+    """ Empties the database the tests are using """
+    if using_own_db():
+        # the worker owns its database so it is emptied in one round-trip
+        server.Item.redis.flushdb()
+        server.invalidate_list_cache()
+    else:
+        # the database may be shared so only the Item keys are removed
+        server.data_reset()
+
+
+def restore(snapshot):
+    """ Puts the sample Items back without validating and saving them again """
+    own_db = using_own_db()
+    if not own_db:
+        # the database may be shared so only the Item keys are removed
+        server.data_reset()
+    pipe = server.Item.redis.pipeline()
+    if own_db:
+        # the worker owns its database so it is emptied in the same round-trip
+        pipe.flushdb()
+    for key, value in snapshot.items():
+        pipe.restore(key, 0, value)
+    pipe.execute()
+    server.invalidate_list_cache()
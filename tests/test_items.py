@@ -16,12 +16,13 @@
 Item Test Suite
 
 Test cases can be run with the following:
-nosetests -v --with-spec --spec-color
+pytest -n auto tests/test_items.py
 """
 
-import unittest
 import os
 import json
+import threading
+import pytest
 from mock import patch
 from redis import Redis, ConnectionError
 from werkzeug.exceptions import NotFound
@@ -34,188 +35,322 @@ if not VCAP_SERVICES:
     VCAP_SERVICES = '{"rediscloud": [{"credentials": {' \
         '"password": "", "hostname": "127.0.0.1", "port": "6379"}}]}'
 
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0')
+
 
 ######################################################################
-#  T E S T   C A S E S
+#  F I X T U R E S
 ######################################################################
-class TestItems(unittest.TestCase):
-    """ Test Cases for Item Model """
 
-    def setUp(self):
-        """ Initialize the Redis database """
-        Item.init_db()
-        Item.remove_all()
-
-    def test_create_a_item(self):
-        """ Create a item and assert that it exists """
-        item = Item(0, "fido", "dog", False)
-        self.assertNotEqual(item, None)
-        self.assertEqual(item.id, 0)
-        self.assertEqual(item.name, "fido")
-        self.assertEqual(item.price, "dog")
-        self.assertEqual(item.available, False)
-
-    def test_add_a_item(self):
-        """ Create a item and add it to the database """
-        items = Item.all()
-        self.assertEqual(items, [])
-        item = Item(0, "fido", "dog", True)
-        self.assertTrue(item != None)
-        self.assertEqual(item.id, 0)
-        item.save()
-        # Asert that it was assigned an id and shows up in the database
-        self.assertEqual(item.id, 1)
-        items = Item.all()
-        self.assertEqual(len(items), 1)
-        self.assertEqual(items[0].id, 1)
-        self.assertEqual(items[0].name, "fido")
-        self.assertEqual(items[0].price, "dog")
-        self.assertEqual(items[0].available, True)
-
-    def test_update_a_item(self):
-        """ Update a Item """
-        item = Item(0, "fido", "dog", True)
-        item.save()
-        self.assertEqual(item.id, 1)
-        # Change it an save it
-        item.price = "k9"
-        item.save()
-        self.assertEqual(item.id, 1)
-        # Fetch it back and make sure the id hasn't changed
-        # but the data did change
-        items = Item.all()
-        self.assertEqual(len(items), 1)
-        self.assertEqual(items[0].price, "k9")
-        self.assertEqual(items[0].name, "fido")
-
-    def test_delete_a_item(self):
-        """ Delete a Item """
-        item = Item(0, "fido", "dog")
-        item.save()
-        self.assertEqual(len(Item.all()), 1)
-        # delete the item and make sure it isn't in the database
-        item.delete()
-        self.assertEqual(len(Item.all()), 0)
-
-    def test_serialize_a_item(self):
-        """ Serialize a Item """
-        item = Item(0, "fido", "dog")
-        data = item.serialize()
-        self.assertNotEqual(data, None)
-        self.assertIn('id', data)
-        self.assertEqual(data['id'], 0)
-        self.assertIn('name', data)
-        self.assertEqual(data['name'], "fido")
-        self.assertIn('price', data)
-        self.assertEqual(data['price'], "dog")
-
-    def test_deserialize_a_item(self):
-        """ Deserialize a Item """
-        data = {"id":1, "name": "kitty", "price": "cat", "available": True}
-        item = Item(data['id'])
-        item.deserialize(data)
-        self.assertNotEqual(item, None)
-        self.assertEqual(item.id, 1)
-        self.assertEqual(item.name, "kitty")
-        self.assertEqual(item.price, "cat")
-
-    def test_deserialize_with_no_name(self):
-        """ Deserialize a Item that has no name """
-        data = {"id":0, "price": "cat"}
-        item = Item(0)
-        self.assertRaises(DataValidationError, item.deserialize, data)
-
-    def test_deserialize_with_no_data(self):
-        """ Deserialize a Item that has no data """
-        item = Item(0)
-        self.assertRaises(DataValidationError, item.deserialize, None)
-
-    def test_deserialize_with_bad_data(self):
-        """ Deserialize a Item that has bad data """
-        item = Item(0)
-        self.assertRaises(DataValidationError, item.deserialize, "string data")
-
-    def test_save_a_item_with_no_name(self):
-        """ Save a Item with no name """
-        item = Item(0, None, "cat")
-        self.assertRaises(DataValidationError, item.save)
-
-    def test_find_item(self):
-        """ Find a Item by id """
-        Item(0, "fido", "dog").save()
-        Item(0, "kitty", "cat").save()
-        item = Item.find(2)
-        self.assertIsNot(item, None)
-        self.assertEqual(item.id, 2)
-        self.assertEqual(item.name, "kitty")
-
-    def test_find_with_no_items(self):
-        """ Find a Item with empty database """
-        item = Item.find(1)
-        self.assertIs(item, None)
-
-    def test_item_not_found(self):
-        """ Find a Item that doesnt exist """
-        Item(0, "fido", "dog").save()
-        item = Item.find(2)
-        self.assertIs(item, None)
-
-    def test_find_by_name(self):
-        """ Find a Item by Name """
-        Item(0, "fido", "dog").save()
-        Item(0, "kitty", "cat").save()
-        items = Item.find_by_name("fido")
-        self.assertNotEqual(len(items), 0)
-        self.assertEqual(items[0].price, "dog")
-        self.assertEqual(items[0].name, "fido")
-
-    def test_find_by_price(self):
-        """ Find a Item by Price """
-        Item(0, "fido", "dog").save()
-        Item(0, "kitty", "cat").save()
-        items = Item.find_by_price("cat")
-        self.assertNotEqual(len(items), 0)
-        self.assertEqual(items[0].price, "cat")
-        self.assertEqual(items[0].name, "kitty")
-
-    def test_find_by_availability(self):
-        """ Find a Item by Availability """
-        Item(0, "fido", "dog", False).save()
-        Item(0, "kitty", "cat", True).save()
-        items = Item.find_by_availability(True)
-        self.assertEqual(len(items), 1)
-        self.assertEqual(items[0].name, "kitty")
-
-    def test_for_case_insensitive(self):
-        """ Test for Case Insensitive Search """
-        Item(0, "Fido", "DOG").save()
-        Item(0, "Kitty", "CAT").save()
-        items = Item.find_by_name("fido")
-        self.assertNotEqual(len(items), 0)
-        self.assertEqual(items[0].name, "Fido")
-        items = Item.find_by_price("cat")
-        self.assertNotEqual(len(items), 0)
-        self.assertEqual(items[0].price, "CAT")
-
-#    @patch.dict(os.environ, {'VCAP_SERVICES': json.dumps(VCAP_SERVICES).encode('utf8')})
-    @patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
-    def test_vcap_services(self):
-        """ Test if VCAP_SERVICES works """
-        Item.init_db()
-        self.assertIsNotNone(Item.redis)
+@pytest.fixture(scope='module', autouse=True)
+def redis_db():
+    """ Initialize the Redis database once for the module """
+    Item.init_db()
 
-    @patch('redis.Redis.ping')
-    def test_redis_connection_error(self, ping_error_mock):
-        """ Test a Bad Redis connection """
-        ping_error_mock.side_effect = ConnectionError()
-        self.assertRaises(ConnectionError, Item.init_db)
-        self.assertIsNone(Item.redis)
+
+# every test starts with an empty database, see conftest.py
+pytestmark = pytest.mark.usefixtures('empty_db')
 
 
 ######################################################################
-#   M A I N
+#  T E S T   C A S E S
 ######################################################################
-if __name__ == '__main__':
-    unittest.main()
-    # suite = unittest.TestLoader().loadTestsFromTestCase(TestItems)
-    # unittest.TextTestRunner(verbosity=2).run(suite)
+
+def test_create_a_item():
+    """ Create a item and assert that it exists """
+    item = Item(0, "fido", "dog", False)
+    assert item != None
+    assert item.id == 0
+    assert item.name == "fido"
+    assert item.price == "dog"
+    assert item.available == False
+
+def test_add_a_item():
+    """ Create a item and add it to the database """
+    items = Item.all()
+    assert items == []
+    item = Item(0, "fido", "dog", True)
+    assert item != None
+    assert item.id == 0
+    item.save()
+    # Asert that it was assigned an id and shows up in the database
+    assert item.id == 1
+    items = Item.all()
+    assert len(items) == 1
+    assert items[0].id == 1
+    assert items[0].name == "fido"
+    assert items[0].price == "dog"
+    assert items[0].available == True
+
+def test_save_many_items():
+    """ Save a list of Items at once """
+    Item(0, "fido", "dog").save()
+    items = [Item(0, "kitty", "cat"), Item(0, "sammy", "snake", False)]
+    Item.save_many(items)
+    assert [item.id for item in items] == [2, 3]
+    assert len(Item.all()) == 3
+    assert Item.find(3).name == "sammy"
+    assert len(Item.find_by_availability(True)) == 2
+
+def test_save_many_with_no_name():
+    """ Save a list of Items where one has no name """
+    items = [Item(0, "kitty", "cat"), Item(0, None, "snake")]
+    with pytest.raises(DataValidationError):
+        Item.save_many(items)
+    assert Item.all() == []
+
+def test_count_items():
+    """ Count the Items """
+    assert Item.count() == 0
+    Item(0, "fido", "dog", True).save()
+    Item(0, "kitty", "cat", False).save()
+    assert Item.count() == 2
+
+def test_writes_change_the_generation():
+    """ Every kind of write changes the generation """
+    seen = set([Item.generation()])
+    item = Item(0, "fido", "dog")
+    for write in (item.save, lambda: Item.save_many([Item(0, "kitty", "cat")]),
+                  lambda: Item.purchase(1), item.delete, Item.remove_all):
+        write()
+        assert Item.generation() not in seen
+        seen.add(Item.generation())
+
+def test_update_a_item():
+    """ Update a Item """
+    item = Item(0, "fido", "dog", True)
+    item.save()
+    assert item.id == 1
+    # Change it an save it
+    item.price = "k9"
+    item.save()
+    assert item.id == 1
+    # Fetch it back and make sure the id hasn't changed
+    # but the data did change
+    items = Item.all()
+    assert len(items) == 1
+    assert items[0].price == "k9"
+    assert items[0].name == "fido"
+
+def test_delete_a_item():
+    """ Delete a Item """
+    item = Item(0, "fido", "dog")
+    item.save()
+    assert len(Item.all()) == 1
+    # delete the item and make sure it isn't in the database
+    item.delete()
+    assert len(Item.all()) == 0
+
+def test_purchase_a_item():
+    """ Purchase a Item """
+    Item(0, "fido", "dog", True).save()
+    item = Item.purchase(1)
+    assert item.available == False
+    # Fetch it back and make sure only availability changed
+    item = Item.find(1)
+    assert item.available == False
+    assert item.name == "fido"
+    assert Item.find_by_availability(True) == []
+    assert len(Item.find_by_availability(False)) == 1
+
+def test_purchase_not_available():
+    """ Purchase a Item that is not available """
+    Item(0, "fido", "dog", False).save()
+    assert Item.purchase(1) is False
+
+def test_purchase_not_found():
+    """ Purchase a Item that doesnt exist """
+    assert Item.purchase(1) is None
+
+def test_remove_all_items():
+    """ Remove all Items but leave unrelated keys alone """
+    Item.redis.set('unrelated', 'value')
+    Item(0, "fido", "dog").save()
+    Item(0, "kitty", "cat").save()
+    Item.remove_all()
+    assert Item.all() == []
+    assert Item.find_by_name("fido") == []
+    assert Item.redis.get('unrelated') == 'value'
+    # ids start over once everything is removed
+    item = Item(0, "sammy", "snake")
+    item.save()
+    assert item.id == 1
+    Item.redis.delete('unrelated')
+
+def test_serialize_a_item():
+    """ Serialize a Item """
+    item = Item(0, "fido", "dog")
+    data = item.serialize()
+    assert data != None
+    assert 'id' in data
+    assert data['id'] == 0
+    assert 'name' in data
+    assert data['name'] == "fido"
+    assert 'price' in data
+    assert data['price'] == "dog"
+
+def test_deserialize_a_item():
+    """ Deserialize a Item """
+    data = {"id":1, "name": "kitty", "price": "cat", "available": True}
+    item = Item(data['id'])
+    item.deserialize(data)
+    assert item != None
+    assert item.id == 1
+    assert item.name == "kitty"
+    assert item.price == "cat"
+
+def test_from_trusted_dict():
+    """ Create a Item from trusted data """
+    data = {"id": "1", "name": "kitty", "price": "cat", "available": False}
+    item = Item.from_trusted_dict(data)
+    assert item.id == 1
+    assert item.name == "kitty"
+    assert item.price == "cat"
+    assert item.available == False
+
+def test_deserialize_in_threads():
+    """ Deserialize Items from several threads at once """
+    failures = []
+    def deserialize_many(name):
+        for _ in range(200):
+            try:
+                Item(0).deserialize({"name": name, "price": "cat", "available": True})
+                Item(0).deserialize({"price": "cat"})
+                failures.append('invalid data was accepted')
+            except DataValidationError as error:
+                if 'name' not in str(error):
+                    failures.append(str(error))
+            except Exception as error:  # pylint: disable=broad-except
+                failures.append(repr(error))
+    threads = [threading.Thread(target=deserialize_many, args=(str(i),)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
+
+def test_deserialize_with_no_name():
+    """ Deserialize a Item that has no name """
+    data = {"id":0, "price": "cat"}
+    item = Item(0)
+    with pytest.raises(DataValidationError):
+        item.deserialize(data)
+
+def test_deserialize_with_no_data():
+    """ Deserialize a Item that has no data """
+    item = Item(0)
+    with pytest.raises(DataValidationError):
+        item.deserialize(None)
+
+def test_deserialize_with_bad_data():
+    """ Deserialize a Item that has bad data """
+    item = Item(0)
+    with pytest.raises(DataValidationError):
+        item.deserialize("string data")
+
+def test_save_a_item_with_no_name():
+    """ Save a Item with no name """
+    item = Item(0, None, "cat")
+    with pytest.raises(DataValidationError):
+        item.save()
+
+def test_find_item():
+    """ Find a Item by id """
+    Item(0, "fido", "dog").save()
+    Item(0, "kitty", "cat").save()
+    item = Item.find(2)
+    assert item is not None
+    assert item.id == 2
+    assert item.name == "kitty"
+
+def test_find_with_no_items():
+    """ Find a Item with empty database """
+    item = Item.find(1)
+    assert item is None
+
+def test_item_not_found():
+    """ Find a Item that doesnt exist """
+    Item(0, "fido", "dog").save()
+    item = Item.find(2)
+    assert item is None
+
+def test_find_by_name():
+    """ Find a Item by Name """
+    Item(0, "fido", "dog").save()
+    Item(0, "kitty", "cat").save()
+    items = Item.find_by_name("fido")
+    assert len(items) != 0
+    assert items[0].price == "dog"
+    assert items[0].name == "fido"
+
+def test_find_by_price():
+    """ Find a Item by Price """
+    Item(0, "fido", "dog").save()
+    Item(0, "kitty", "cat").save()
+    items = Item.find_by_price("cat")
+    assert len(items) != 0
+    assert items[0].price == "cat"
+    assert items[0].name == "kitty"
+
+def test_find_by_availability():
+    """ Find a Item by Availability """
+    Item(0, "fido", "dog", False).save()
+    Item(0, "kitty", "cat", True).save()
+    items = Item.find_by_availability(True)
+    assert len(items) == 1
+    assert items[0].name == "kitty"
+
+def test_non_ascii_item():
+    """ Update and delete a Item with a non-ASCII name """
+    item = Item(0, u"Caf\xe9", u"\xc9clair")
+    item.save()
+    item = Item.find(1)
+    assert item.name == u"Caf\xe9"
+    assert item.price == u"\xc9clair"
+    assert len(Item.find_by_name(u"CAF\xc9")) == 1
+    item.price = u"cr\xeape"
+    item.save()
+    assert Item.find_by_price(u"\xe9clair") == []
+    assert Item.find_by_price(u"CR\xcaPE")[0].name == u"Caf\xe9"
+    item.delete()
+    assert Item.find_by_name(u"caf\xe9") == []
+    assert Item.count() == 0
+
+def test_for_case_insensitive():
+    """ Test for Case Insensitive Search """
+    Item(0, "Fido", "DOG").save()
+    Item(0, "Kitty", "CAT").save()
+    items = Item.find_by_name("fido")
+    assert len(items) != 0
+    assert items[0].name == "Fido"
+    items = Item.find_by_price("cat")
+    assert len(items) != 0
+    assert items[0].price == "CAT"
+
+# @patch.dict(os.environ, {'VCAP_SERVICES': json.dumps(VCAP_SERVICES).encode('utf8')})
+@patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
+def test_vcap_services():
+    """ Test if VCAP_SERVICES works """
+    Item.init_db()
+    assert Item.redis is not None
+
+@patch.dict(os.environ, {'REDIS_URL': REDIS_URL})
+def test_redis_url():
+    """ Test if REDIS_URL works """
+    Item.init_db()
+    assert Item.redis is not None
+
+def test_connection_pool_is_shared():
+    """ Test that init_db reuses the connection pool """
+    Item.init_db()
+    pool = Item.redis.connection_pool
+    Item.init_db()
+    assert Item.redis.connection_pool is pool
+
+@patch('redis.Redis.ping')
+def test_redis_connection_error(ping_error_mock):
+    """ Test a Bad Redis connection """
+    ping_error_mock.side_effect = ConnectionError()
+    with pytest.raises(ConnectionError):
+        Item.init_db()
+    assert Item.redis is None
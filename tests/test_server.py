@@ -16,12 +16,17 @@
 Item API Service Test Suite
 
 Test cases can be run with the following:
-nosetests -v --with-spec --spec-color
+pytest -n auto tests/test_server.py
+
+The client fixture is defined in conftest.py
 """
 
-import unittest
-import logging
-import json
+try:
+    import ujson as json    # C parser, same API for loads/dumps
+except ImportError:
+    import json
+import pytest
+from mock import patch
 from app import server
 
 # Status Codes
@@ -33,176 +38,206 @@ HTTP_404_NOT_FOUND = 404
 HTTP_405_METHOD_NOT_ALLOWED = 405
 HTTP_409_CONFLICT = 409
 
+# The index page header is within the first bytes of the page
+INDEX_HEADER_END = 1024
+
+# Request payloads are only encoded once
+SAMMY_JSON = json.dumps({'name': 'sammy', 'price': 'snake', 'available': True})
+KITTY_TABBY_JSON = json.dumps({'name': 'kitty', 'price': 'tabby', 'available': True})
+NO_NAME_JSON = json.dumps({'price': 'dog'})
+CAFE_JSON = json.dumps({'name': u'Caf\xe9', 'price': u'\xe9clair', 'available': True})
+TIMOTHY_JSON = json.dumps({"name": "timothy", "price": "mouse"})
+
 ######################################################################
-#  T E S T   C A S E S
+#  R E A D   O N L Y   T E S T   C A S E S
 ######################################################################
-class TestItemServer(unittest.TestCase):
-    """ Item Service tests """
-
-    def setUp(self):
-        self.app = server.app.test_client()
-        server.initialize_logging(logging.CRITICAL)
-        server.init_db()
-        server.data_reset()
-        server.data_load({"name": "fido", "price": "dog", "available": True})
-        server.data_load({"name": "kitty", "price": "cat", "available": True})
-
-    def test_index(self):
+
+class TestReadOnly(object):
+    """ Tests that never change the Items share a single restore """
+
+    @pytest.fixture
+    def client(self, readonly_client):
+        """ Uses the client that is only restored once for this class """
+        return readonly_client
+
+    def test_index(self, client):
         """ Test the index page """
-        resp = self.app.get('/')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        self.assertIn('Item Demo REST API Service', resp.data)
+        resp = client.get('/')
+        assert resp.status_code == HTTP_200_OK
+        assert resp.data.startswith(b'<!DOCTYPE html>')
+        # the page header is near the top so only the head of the page is searched
+        assert resp.data.find(b'<h1>Item Demo REST API Service</h1>', 0, INDEX_HEADER_END) != -1
 
-    def test_get_item_list(self):
+    def test_get_item_list(self, client):
         """ Get a list of Items """
-        resp = self.app.get('/items')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        self.assertTrue(len(resp.data) > 0)
-
-    def test_get_item(self):
+        resp = client.get('/items')
+        assert resp.status_code == HTTP_200_OK
+        assert len(resp.data) > 0
+        assert resp.headers['X-Total-Count'] == str(len(json.loads(resp.data)))
+
+    def test_count_items(self, client):
+        """ Count the Items without listing them """
+        resp = client.head('/items')
+        assert resp.status_code == HTTP_200_OK
+        assert len(resp.data) == 0
+        assert resp.headers['X-Total-Count'] == '2'
+
+    def test_get_item(self, client):
         """ get a single Item """
-        resp = self.app.get('/items/2')
-        #print 'resp_data: ' + resp.data
-        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = client.get('/items/2')
+        assert resp.status_code == HTTP_200_OK
         data = json.loads(resp.data)
-        self.assertEqual(data['name'], 'kitty')
+        assert data['name'] == 'kitty'
 
-    def test_get_item_not_found(self):
+    def test_get_item_not_found(self, client):
         """ Get a Item that doesn't exist """
-        resp = self.app.get('/items/0')
-        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+        resp = client.get('/items/0')
+        assert resp.status_code == HTTP_404_NOT_FOUND
         data = json.loads(resp.data)
-        self.assertIn('was not found', data['message'])
-
-    def test_create_item(self):
-        """ Create a new Item """
-        # save the current number of items for later comparrison
-        item_count = self.get_item_count()
-        # add a new item
-        new_item = {'name': 'sammy', 'price': 'snake', 'available': True}
-        data = json.dumps(new_item)
-        resp = self.app.post('/items', data=data, content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_201_CREATED)
-        # Make sure location header is set
-        location = resp.headers.get('Location', None)
-        self.assertNotEqual(location, None)
-        # Check the data is correct
-        new_json = json.loads(resp.data)
-        self.assertEqual(new_json['name'], 'sammy')
-        # check that count has gone up and includes sammy
-        resp = self.app.get('/items')
-        # print 'resp_data(2): ' + resp.data
-        data = json.loads(resp.data)
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        self.assertEqual(len(data), item_count + 1)
-        self.assertIn(new_json, data)
-
-    def test_update_item(self):
-        """ Update a Item """
-        new_kitty = {'name': 'kitty', 'price': 'tabby', 'available': True}
-        data = json.dumps(new_kitty)
-        resp = self.app.put('/items/2', data=data, content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        resp = self.app.get('/items/2', content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        new_json = json.loads(resp.data)
-        self.assertEqual(new_json['price'], 'tabby')
-
-    def test_update_item_with_no_name(self):
-        """ Update a Item without assigning a name """
-        new_item = {'price': 'dog'}
-        data = json.dumps(new_item)
-        resp = self.app.put('/items/2', data=data, content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
-
-    def test_update_item_not_found(self):
-        """ Update a Item that doesn't exist """
-        new_kitty = {"name": "timothy", "price": "mouse"}
-        data = json.dumps(new_kitty)
-        resp = self.app.put('/items/0', data=data, content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
-
-    def test_delete_item(self):
-        """ Delete a Item """
-        # save the current number of items for later comparrison
-        item_count = self.get_item_count()
-        # delete a item
-        resp = self.app.delete('/items/2', content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_204_NO_CONTENT)
-        self.assertEqual(len(resp.data), 0)
-        new_count = self.get_item_count()
-        self.assertEqual(new_count, item_count - 1)
-
-    def test_create_item_with_no_name(self):
-        """ Create a Item without a name """
-        new_item = {'price': 'dog'}
-        data = json.dumps(new_item)
-        resp = self.app.post('/items', data=data, content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
-
-    def test_create_item_no_content_type(self):
-        """ Create a Item with no Content-Type """
-        new_item = {'price': 'dog'}
-        data = json.dumps(new_item)
-        resp = self.app.post('/items', data=data)
-        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
-
-    def test_get_nonexisting_item(self):
+        assert 'was not found' in data['message']
+
+    def test_get_nonexisting_item(self, client):
         """ Get a nonexisting Item """
-        resp = self.app.get('/items/5')
-        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+        resp = client.get('/items/5')
+        assert resp.status_code == HTTP_404_NOT_FOUND
 
-    def test_call_create_with_an_id(self):
+    def test_call_create_with_an_id(self, client):
         """ Call create passing anid """
-        new_item = {'name': 'sammy', 'price': 'snake'}
-        data = json.dumps(new_item)
-        resp = self.app.post('/items/1', data=data)
-        self.assertEqual(resp.status_code, HTTP_405_METHOD_NOT_ALLOWED)
+        resp = client.post('/items/1', data=SAMMY_JSON)
+        assert resp.status_code == HTTP_405_METHOD_NOT_ALLOWED
 
-    def test_query_item_list(self):
+    def test_query_item_list(self, client):
         """ Query Items by price """
-        resp = self.app.get('/items', query_string='price=dog')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        self.assertTrue(len(resp.data) > 0)
-        self.assertIn('fido', resp.data)
-        self.assertNotIn('kitty', resp.data)
+        resp = client.get('/items', query_string='price=dog')
+        assert resp.status_code == HTTP_200_OK
         data = json.loads(resp.data)
-        query_item = data[0]
-        self.assertEqual(query_item['price'], 'dog')
-
-    def test_purchase_a_item(self):
-        """ Purchase a Item """
-        resp = self.app.put('/items/2/purchase', content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        resp = self.app.get('/items/2', content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        item_data = json.loads(resp.data)
-        self.assertEqual(item_data['available'], False)
-
-    def test_purchase_not_available(self):
-        """ Purchase a Item that is not available """
-        resp = self.app.put('/items/2/purchase', content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        resp = self.app.put('/items/2/purchase', content_type='application/json')
-        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
-        resp_json = json.loads(resp.get_data())
-        self.assertIn('not available', resp_json['message'])
+        names = set(item['name'] for item in data)
+        assert 'fido' in names
+        assert 'kitty' not in names
+        assert data[0]['price'] == 'dog'
 
 
 ######################################################################
-# Utility functions
+#  T E S T   C A S E S
 ######################################################################
 
-    def get_item_count(self):
-        """ save the current number of items """
-        resp = self.app.get('/items')
-        self.assertEqual(resp.status_code, HTTP_200_OK)
-        data = json.loads(resp.data)
-        return len(data)
+def test_get_item_list_cached(client):
+    """ Get a cached list of Items """
+    get = client.get
+    with patch.object(server.Item, 'all', wraps=server.Item.all) as all_items:
+        item_count = len(json.loads(get('/items').data))
+        assert len(json.loads(get('/items').data)) == item_count
+        assert all_items.call_count == 1
+        # a write made by another process is seen through Redis
+        server.Item(0, 'sammy', 'snake').save()
+        assert len(json.loads(get('/items').data)) == item_count + 1
+        assert all_items.call_count == 2
+
+def test_create_item(client):
+    """ Create a new Item """
+    post = client.post
+    # save the current number of items for later comparrison
+    item_count = get_item_count(client)
+    # add a new item
+    resp = post('/items', data=SAMMY_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_201_CREATED
+    # Make sure location header is set
+    location = resp.headers.get('Location', None)
+    assert location == 'http://localhost/items/3'
+    # Check the data is correct
+    new_json = json.loads(resp.data)
+    assert new_json['name'] == 'sammy'
+    assert new_json['id'] == 3
+    # check that count has gone up without parsing the list again
+    assert get_item_count(client) == item_count + 1
+
+def test_update_item(client):
+    """ Update a Item """
+    get, put = client.get, client.put
+    resp = put('/items/2', data=KITTY_TABBY_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_200_OK
+    resp = get('/items/2', content_type='application/json')
+    assert resp.status_code == HTTP_200_OK
+    new_json = json.loads(resp.data)
+    assert new_json['price'] == 'tabby'
+
+def test_update_and_delete_non_ascii_item(client):
+    """ Update and delete a Item with a non-ASCII name """
+    resp = client.post('/items', data=CAFE_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_201_CREATED
+    location = resp.headers['Location']
+    resp = client.put(location, data=KITTY_TABBY_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_200_OK
+    assert json.loads(resp.data)['name'] == 'kitty'
+    resp = client.put(location, data=CAFE_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_200_OK
+    resp = client.delete(location)
+    assert resp.status_code == HTTP_204_NO_CONTENT
+    resp = client.get('/items', query_string={'name': u'caf\xe9'})
+    assert json.loads(resp.data) == []
+
+def test_update_item_with_no_name(client):
+    """ Update a Item without assigning a name """
+    resp = client.put('/items/2', data=NO_NAME_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_400_BAD_REQUEST
+
+def test_update_item_not_found(client):
+    """ Update a Item that doesn't exist """
+    resp = client.put('/items/0', data=TIMOTHY_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_404_NOT_FOUND
+
+def test_delete_item(client):
+    """ Delete a Item """
+    # save the current number of items for later comparrison
+    item_count = get_item_count(client)
+    # delete a item
+    resp = client.delete('/items/2', content_type='application/json')
+    assert resp.status_code == HTTP_204_NO_CONTENT
+    assert len(resp.data) == 0
+    new_count = get_item_count(client)
+    assert new_count == item_count - 1
+
+def test_create_item_with_no_name(client):
+    """ Create a Item without a name """
+    resp = client.post('/items', data=NO_NAME_JSON, content_type='application/json')
+    assert resp.status_code == HTTP_400_BAD_REQUEST
+
+def test_create_item_no_content_type(client):
+    """ Create a Item with no Content-Type """
+    resp = client.post('/items', data=NO_NAME_JSON)
+    assert resp.status_code == HTTP_400_BAD_REQUEST
+
+def test_create_item_with_bad_json(client):
+    """ Create a Item with a malformed JSON body """
+    resp = client.post('/items', data='{"name": ', content_type='application/json')
+    assert resp.status_code == HTTP_400_BAD_REQUEST
+
+def test_purchase_a_item(client):
+    """ Purchase a Item """
+    resp = client.put('/items/2/purchase', content_type='application/json')
+    assert resp.status_code == HTTP_200_OK
+    # the purchase returns the updated Item so it isn't fetched again
+    item_data = json.loads(resp.data)
+    assert item_data['id'] == 2
+    assert item_data['available'] == False
+
+def test_purchase_not_available(client):
+    """ Purchase a Item that is not available """
+    put = client.put
+    resp = put('/items/2/purchase', content_type='application/json')
+    assert resp.status_code == HTTP_200_OK
+    resp = put('/items/2/purchase', content_type='application/json')
+    assert resp.status_code == HTTP_400_BAD_REQUEST
+    resp_json = json.loads(resp.data)
+    assert 'not available' in resp_json['message']
 
 
 ######################################################################
-#   M A I N
+# Utility functions
 ######################################################################
-if __name__ == '__main__':
-    unittest.main()
+
+def get_item_count(client):
+    """ save the current number of items """
+    resp = client.head('/items')
+    assert resp.status_code == HTTP_200_OK
+    return int(resp.headers['X-Total-Count'])